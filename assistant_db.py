@@ -1,36 +1,107 @@
-import sqlite3, json
+import os, sqlite3, json
+from contextlib import contextmanager
 import numpy as np
-from utils import now, new_id, compute_commit
+from utils import now, new_id, compute_commit, quantize_int8, dequantize_int8_rows, format_prompt
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "init_db.sql"), "r") as f:
+    _INIT_SQL = f.read()
+
+# stored in PRAGMA user_version; bump whenever init_db.sql or _migrate() changes
+SCHEMA_VERSION = 2
+
+_DBS = {}
+
+def get_db(path="assistant.sqlite"):
+    """Return the process-wide AssistantDB for path, opening it on first use."""
+    key = os.path.abspath(path)
+    db = _DBS.get(key)
+    if db is None:
+        db = _DBS[key] = AssistantDB(path)
+    return db
 
 class AssistantDB:
     def __init__(self, path="assistant.sqlite"):
         self.conn = sqlite3.connect(path)
-        self.conn.execute("PRAGMA journal_mode=WAL;")
-        self.conn.execute("PRAGMA synchronous=NORMAL;")
-        with open("init_db.sql", "r") as f:
-            self.conn.executescript(f.read())
-        self.conn.commit()
+        self._configure_conn()
+        self._tx_depth = 0
+        self._emb_cache = {}  # dialog_id -> (ids, M)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            self.conn.executescript(_INIT_SQL)
+            self._migrate()
+            self.conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+    def _configure_conn(self):
+        self.conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-65536;
+            PRAGMA mmap_size=10737418240;
+            PRAGMA busy_timeout=5000;
+            PRAGMA wal_autocheckpoint=1000;
+        """)
+
+    def _migrate(self):
+        # older databases stored raw float32 embeddings next to their norm;
+        # re-encode them as int8 unit vectors so cosine is a plain dot product
+        with self.transaction():
+            cols = {r[1] for r in self.conn.execute("PRAGMA table_info(memory)")}
+            if "norm" not in cols:
+                return
+            self.conn.execute("ALTER TABLE memory ADD COLUMN scale REAL NOT NULL DEFAULT 1.0")
+            updates = []
+            for mid, blob, norm in self.conn.execute(
+                "SELECT memory_id, embedding, norm FROM memory"
+            ).fetchall():
+                q, scale = quantize_int8(np.frombuffer(blob, dtype=np.float32) / norm)
+                updates.append((q.tobytes(), scale, mid))
+            self.conn.executemany(
+                "UPDATE memory SET embedding=?, scale=? WHERE memory_id=?",
+                updates
+            )
+            self.conn.execute("ALTER TABLE memory DROP COLUMN norm")
+
+    @contextmanager
+    def transaction(self):
+        """Group writes into one BEGIN IMMEDIATE ... COMMIT (nested calls join the outer one)."""
+        if self._tx_depth:
+            self._tx_depth += 1
+            try:
+                yield self.conn
+            finally:
+                self._tx_depth -= 1
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        self._tx_depth = 1
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+        finally:
+            self._tx_depth = 0
 
     def create_dialog(self, title, system_prompt, params):
         dialog_id = new_id()
         root_id = new_id()
-        self.conn.execute(
-            "INSERT INTO dialogs VALUES (?,?,?)",
-            (dialog_id, title, now())
-        )
-
         commit_hash = compute_commit(None, [{"role":"system","content":system_prompt}], params)
-        self.conn.execute(
-            "INSERT INTO nodes VALUES (?,?,?,?,?,?,?)",
-            (root_id, dialog_id, None, "root", commit_hash, json.dumps(params), now())
-        )
-
-        self.conn.execute(
-            "INSERT INTO messages VALUES (NULL,?,?,?,?,?)",
-            (dialog_id, root_id, "system", system_prompt, now())
-        )
-        self.conn.commit()
-        self.set_head(dialog_id, root_id)
+        ts = now()
+        with self.transaction():
+            self.conn.execute(
+                "INSERT INTO dialogs VALUES (?,?,?)",
+                (dialog_id, title, ts)
+            )
+            self.conn.execute(
+                "INSERT INTO nodes VALUES (?,?,?,?,?,?,?)",
+                (root_id, dialog_id, None, "root", commit_hash, json.dumps(params), ts)
+            )
+            self.conn.execute(
+                "INSERT INTO messages VALUES (NULL,?,?,?,?,?)",
+                (dialog_id, root_id, "system", system_prompt, ts)
+            )
+            self.set_head(dialog_id, root_id, ts)
         return dialog_id, root_id
 
     def fork(self, dialog_id, parent_node, note, params):
@@ -40,31 +111,27 @@ class AssistantDB:
         ).fetchone()[0]
 
         commit_hash = compute_commit(parent_commit, [], params)
-        self.conn.execute(
-            "INSERT INTO nodes VALUES (?,?,?,?,?,?,?)",
-            (node_id, dialog_id, parent_node, note, commit_hash, json.dumps(params), now())
-        )
-
-        rows = self.conn.execute(
-            "SELECT role,content,created_at FROM messages WHERE node_id=?",
-            (parent_node,)
-        ).fetchall()
-
-        for r,c,t in rows:
+        ts = now()
+        with self.transaction():
             self.conn.execute(
-                "INSERT INTO messages VALUES (NULL,?,?,?,?,?)",
-                (dialog_id, node_id, r, c, t)
+                "INSERT INTO nodes VALUES (?,?,?,?,?,?,?)",
+                (node_id, dialog_id, parent_node, note, commit_hash, json.dumps(params), ts)
+            )
+            self.conn.execute(
+                """INSERT INTO messages(dialog_id, node_id, role, content, created_at)
+                   SELECT ?, ?, role, content, created_at
+                   FROM messages WHERE node_id=? ORDER BY message_id""",
+                (dialog_id, node_id, parent_node)
             )
-        self.conn.commit()
-        self.set_head(dialog_id, node_id)
+            self.set_head(dialog_id, node_id, ts)
         return node_id
 
     def append_message(self, dialog_id, node_id, role, content):
-        self.conn.execute(
-            "INSERT INTO messages VALUES (NULL,?,?,?,?,?)",
-            (dialog_id, node_id, role, content, now())
-        )
-        self.conn.commit()
+        with self.transaction():
+            self.conn.execute(
+                "INSERT INTO messages VALUES (NULL,?,?,?,?,?)",
+                (dialog_id, node_id, role, content, now())
+            )
 
     def get_messages(self, dialog_id, node_id):
         rows = self.conn.execute(
@@ -73,27 +140,110 @@ class AssistantDB:
         ).fetchall()
         return [{"role":r,"content":c} for r,c in rows]
 
+    def iter_messages_as_prompt(self, node_id):
+        """Return the node's messages already flattened for OAClient.respond_prompt()."""
+        return format_prompt(self.conn.execute(
+            "SELECT role, content FROM messages WHERE node_id=? ORDER BY message_id",
+            (node_id,)
+        ))
+
     def add_memory(self, dialog_id, node_id, text, embedding, meta):
-        v = np.asarray(embedding, dtype=np.float32)
-        self.conn.execute(
-            "INSERT INTO memory VALUES (NULL,?,?,?,?,?,?,?)",
-            (dialog_id, node_id, text, v.tobytes(),
-             float(np.linalg.norm(v)+1e-12), json.dumps(meta), now())
-        )
-        self.conn.commit()
-        # ---- heads ----
-
-    def set_head(self, dialog_id, node_id):
-        self.conn.execute(
-            """INSERT INTO dialog_heads(dialog_id, head_node_id, updated_at)
-               VALUES(?,?,?)
-               ON CONFLICT(dialog_id) DO UPDATE SET
-                 head_node_id=excluded.head_node_id,
-                 updated_at=excluded.updated_at
-            """,
-            (dialog_id, node_id, now())
-        )
-        self.conn.commit()
+        self.add_memories(dialog_id, node_id, [(text, embedding, meta)])
+
+    def add_memories(self, dialog_id, node_id, items):
+        """Insert (text, embedding, meta) tuples in a single transaction."""
+        ts = now()
+        rows = []
+        for text, embedding, meta in items:
+            v = np.asarray(embedding, dtype=np.float32)
+            q, scale = quantize_int8(v / (np.linalg.norm(v)+1e-12))
+            rows.append((dialog_id, node_id, text, q.tobytes(), scale, json.dumps(meta), ts))
+        with self.transaction():
+            self.conn.executemany(
+                """INSERT INTO memory(dialog_id, node_id, text, embedding, scale, meta_json, created_at)
+                   VALUES (?,?,?,?,?,?,?)""",
+                rows
+            )
+            if rows and dialog_id in self._emb_cache:
+                # we hold the write lock, so the newest ids for this dialog are ours
+                new_ids = self.conn.execute(
+                    "SELECT memory_id FROM memory WHERE dialog_id=? ORDER BY memory_id DESC LIMIT ?",
+                    (dialog_id, len(rows))
+                ).fetchall()
+                ids, M = self._emb_cache[dialog_id]
+                new_M = dequantize_int8_rows([r[3] for r in rows], [r[4] for r in rows])
+                if not len(ids) or M.shape[1] != new_M.shape[1]:
+                    # empty placeholder or a different embedding width: reload on next use
+                    self._emb_cache.pop(dialog_id, None)
+                else:
+                    self._emb_cache[dialog_id] = (
+                        np.concatenate([ids, np.array([r[0] for r in reversed(new_ids)], dtype=np.int64)]),
+                        np.vstack([M, new_M]),
+                    )
+
+    def get_embedding_matrix(self, dialog_id):
+        """Return (ids, M) for a dialog's memory, M being an (N, D) float32 matrix of unit rows.
+
+        Loaded (and dequantized) once per dialog and kept in sync by add_memories();
+        reloaded if the row count or newest memory_id shows another writer got in.
+        """
+        cached = self._emb_cache.get(dialog_id)
+        if cached is not None:
+            n, max_id = self.conn.execute(
+                "SELECT COUNT(*), MAX(memory_id) FROM memory WHERE dialog_id=?",
+                (dialog_id,)
+            ).fetchone()
+            ids = cached[0]
+            if (len(ids), int(ids[-1]) if len(ids) else None) != (n, max_id):
+                cached = None
+        if cached is None:
+            rows = self.conn.execute(
+                "SELECT memory_id, embedding, scale FROM memory WHERE dialog_id=? ORDER BY memory_id",
+                (dialog_id,)
+            ).fetchall()
+            ids = np.array([r[0] for r in rows], dtype=np.int64)
+            try:
+                M = dequantize_int8_rows([r[1] for r in rows], [r[2] for r in rows])
+            except ValueError as e:
+                raise ValueError(f"dialog {dialog_id}: {e}") from None
+            cached = (ids, M)
+            self._emb_cache[dialog_id] = cached
+        return cached
+
+    # ---- embedding cache ----
+
+    def get_cached_embeddings(self, provider, model, keys):
+        """Return {key: float32 vector} for the keys present in embedding_cache."""
+        if not keys:
+            return {}
+        qmarks = ",".join(["?"] * len(keys))
+        rows = self.conn.execute(
+            f"SELECT key, vec FROM embedding_cache WHERE provider=? AND model=? AND key IN ({qmarks})",
+            (provider, model, *keys)
+        ).fetchall()
+        return {k: np.frombuffer(v, dtype=np.float32) for k, v in rows}
+
+    def put_cached_embeddings(self, provider, model, items):
+        """Store (key, vector) pairs in embedding_cache."""
+        with self.transaction():
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache(provider, model, key, vec) VALUES (?,?,?,?)",
+                [(provider, model, k, np.asarray(v, dtype=np.float32).tobytes()) for k, v in items]
+            )
+
+    # ---- heads ----
+
+    def set_head(self, dialog_id, node_id, ts=None):
+        with self.transaction():
+            self.conn.execute(
+                """INSERT INTO dialog_heads(dialog_id, head_node_id, updated_at)
+                   VALUES(?,?,?)
+                   ON CONFLICT(dialog_id) DO UPDATE SET
+                     head_node_id=excluded.head_node_id,
+                     updated_at=excluded.updated_at
+                """,
+                (dialog_id, node_id, ts if ts is not None else now())
+            )
 
     def get_head(self, dialog_id):
         row = self.conn.execute(
@@ -134,12 +284,17 @@ class AssistantDB:
 
     def lineage(self, node_id):
         """Return [root ... node_id]."""
-        path = []
-        cur = node_id
-        while cur is not None:
-            path.append(cur)
-            cur = self.get_parent(cur)
-        return list(reversed(path))
+        rows = self.conn.execute(
+            """WITH RECURSIVE anc(node_id, parent_id, depth) AS (
+                 SELECT node_id, parent_id, 0 FROM nodes WHERE node_id=?
+                 UNION ALL
+                 SELECT n.node_id, n.parent_id, anc.depth + 1
+                 FROM nodes n JOIN anc ON n.node_id = anc.parent_id
+               )
+               SELECT node_id FROM anc ORDER BY depth DESC""",
+            (node_id,)
+        ).fetchall()
+        return [r[0] for r in rows]
 
     def lca(self, a, b):
         """Lowest common ancestor node_id (within same dialog)."""
@@ -159,6 +314,19 @@ class AssistantDB:
         ).fetchall()
         return [{"role": r, "content": c} for r, c in rows]
 
+    def message_count(self, node_id):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE node_id=?", (node_id,)
+        ).fetchone()[0]
+
+    def messages_after(self, node_id, offset):
+        """Messages of node_id past the first `offset` ones, in order."""
+        rows = self.conn.execute(
+            "SELECT role, content FROM messages WHERE node_id=? ORDER BY message_id LIMIT -1 OFFSET ?",
+            (node_id, offset)
+        ).fetchall()
+        return [{"role": r, "content": c} for r, c in rows]
+
     def set_head_to_node(self, dialog_id, node_id):
         # sanity: ensure node belongs to dialog
         row = self.conn.execute(
@@ -19,12 +19,13 @@ theory = db.fork(dialog_id, root, "theory", params)
 db.append_message(dialog_id, theory, "user",
     "Give a CI-based stopping rule for uniform sampling best-arm ID.")
 
-ans = oa.respond(db.get_messages(dialog_id, theory))
+ans = oa.respond_prompt(db.iter_messages_as_prompt(theory))
 db.append_message(dialog_id, theory, "assistant", ans)
 
-for ch in chunk_text(ans):
-    emb = oa.embed([ch])[0]
-    db.add_memory(dialog_id, theory, ch, emb, {"branch":"theory"})
+chunks = chunk_text(ans)
+embs = oa.embed(chunks)
+db.add_memories(dialog_id, theory,
+    [(ch, emb, {"branch":"theory"}) for ch, emb in zip(chunks, embs)])
 
 hits = hybrid_retrieve(db, oa, dialog_id,
     "early stopping uniform sampling", k=3)
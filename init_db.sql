@@ -5,6 +5,8 @@ CREATE TABLE IF NOT EXISTS dialogs (
   created_at REAL NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS idx_dialogs_created ON dialogs(created_at);
+
 -- branching nodes
 CREATE TABLE IF NOT EXISTS nodes (
   node_id TEXT PRIMARY KEY,
@@ -16,7 +18,9 @@ CREATE TABLE IF NOT EXISTS nodes (
   created_at REAL NOT NULL
 );
 
-CREATE INDEX IF NOT EXISTS idx_nodes_dialog ON nodes(dialog_id);
+-- (dialog_id, created_at) also serves plain dialog_id lookups
+DROP INDEX IF EXISTS idx_nodes_dialog;
+CREATE INDEX IF NOT EXISTS idx_nodes_dialog_created ON nodes(dialog_id, created_at);
 CREATE INDEX IF NOT EXISTS idx_nodes_parent ON nodes(parent_id);
 
 -- messages
@@ -29,6 +33,7 @@ CREATE TABLE IF NOT EXISTS messages (
   created_at REAL NOT NULL
 );
 
+-- message_id is the rowid, so this index already yields rows in message_id order
 CREATE INDEX IF NOT EXISTS idx_messages_node ON messages(node_id);
 
 -- vector memory
@@ -37,10 +42,10 @@ CREATE TABLE IF NOT EXISTS memory (
   dialog_id TEXT NOT NULL,
   node_id TEXT,
   text TEXT NOT NULL,
-  embedding BLOB NOT NULL,
-  norm REAL NOT NULL,
+  embedding BLOB NOT NULL,  -- int8 unit vector, dequantized as embedding * scale
   meta_json TEXT NOT NULL,
-  created_at REAL NOT NULL
+  created_at REAL NOT NULL,
+  scale REAL NOT NULL
 );
 
 CREATE INDEX IF NOT EXISTS idx_memory_dialog ON memory(dialog_id);
@@ -68,4 +73,13 @@ CREATE TABLE IF NOT EXISTS dialog_heads (
   dialog_id TEXT PRIMARY KEY,
   head_node_id TEXT NOT NULL,
   updated_at REAL NOT NULL
-);
\ No newline at end of file
+);
+
+-- embeddings of arbitrary texts (e.g. retrieval queries), keyed by utils.content_key
+CREATE TABLE IF NOT EXISTS embedding_cache (
+  provider TEXT NOT NULL,
+  model TEXT NOT NULL,
+  key BLOB NOT NULL,
+  vec BLOB NOT NULL,  -- float32
+  PRIMARY KEY (provider, model, key)
+) WITHOUT ROWID;
@@ -1,13 +1,34 @@
+import base64, functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from openai import OpenAI
+from utils import content_key, format_prompt
+
+@functools.lru_cache(maxsize=4)
+def _get_client(api_key=None):
+    # one OpenAI client (and its HTTP connection pool) per key per process;
+    # api_key=None lets the SDK read OPENAI_API_KEY as before
+    return OpenAI(api_key=api_key)
 
 class OAClient:
-    def __init__(self, model, embed_model):
-        self.client = OpenAI()
+    provider = "openai"
+
+    def __init__(self, model, embed_model, max_batch=96, max_workers=8, cache_size=4096, api_key=None):
+        self.client = _get_client(api_key)
         self.model = model
         self.embed_model = embed_model
+        self.max_batch = max_batch
+        self.max_workers = max_workers
+        self.cache_size = cache_size
+        self._embed_cache = OrderedDict()  # (embed_model, content_key) -> vector
 
     def respond(self, messages, temperature=0.2, max_tokens=800):
-        prompt = "\n\n".join(f"{m['role'].upper()}: {m['content']}" for m in messages)
+        prompt = format_prompt((m["role"], m["content"]) for m in messages)
+        return self.respond_prompt(prompt, temperature=temperature, max_tokens=max_tokens)
+
+    def respond_prompt(self, prompt, temperature=0.2, max_tokens=800):
+        """Like respond(), for a prompt already flattened with format_prompt()."""
         r = self.client.responses.create(
             model=self.model,
             input=prompt,
@@ -17,8 +38,46 @@ class OAClient:
         return r.output_text
 
     def embed(self, texts):
+        """Return a (len(texts), D) float32 array; repeated texts are served from an LRU cache."""
+        texts = list(texts)
+        keys = [(self.embed_model, content_key(t)) for t in texts]
+        rows = []
+        misses = {}
+        for t, key in zip(texts, keys):
+            v = self._embed_cache.get(key)
+            if v is not None:
+                self._embed_cache.move_to_end(key)
+            else:
+                misses.setdefault(key, t)
+            rows.append(v)
+        if misses:
+            fresh = dict(zip(misses, self._embed_uncached(list(misses.values()))))
+            for key, v in fresh.items():
+                # copy: a row view would keep its whole batch buffer alive
+                self._embed_cache[key] = v.copy()
+            while len(self._embed_cache) > self.cache_size:
+                self._embed_cache.popitem(last=False)
+            rows = [fresh[key] if v is None else v for key, v in zip(keys, rows)]
+        if not rows:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack(rows)
+
+    def _embed_uncached(self, texts):
+        if len(texts) <= self.max_batch:
+            return self._embed_batch(texts)
+        # the HTTP calls release the GIL, so windows can be in flight concurrently
+        windows = [texts[i:i + self.max_batch] for i in range(0, len(texts), self.max_batch)]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(windows))) as ex:
+            return np.concatenate(list(ex.map(self._embed_batch, windows)))
+
+    def _embed_batch(self, texts):
+        # ask for base64 so the vectors are decoded straight into one buffer
+        # instead of going through a Python list of floats
         r = self.client.embeddings.create(
             model=self.embed_model,
-            input=texts
+            input=texts,
+            encoding_format="base64",
         )
-        return [d.embedding for d in r.data]
\ No newline at end of file
+        data = sorted(r.data, key=lambda d: d.index)
+        buf = b"".join(base64.b64decode(d.embedding) for d in data)
+        return np.frombuffer(buf, dtype=np.float32).reshape(len(data), -1)
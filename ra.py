@@ -1,22 +1,33 @@
 #!/usr/bin/env python3
 import argparse
 import os
-from assistant_db import AssistantDB
+from assistant_db import get_db
 from oa_client import OAClient
 from utils import chunk_text
 from retrieval import hybrid_retrieve
 import time
-from collections import defaultdict
 
 def auto_branch_name(prefix="branch"):
     return f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}"
+# CLI defaults per provider, looked up once; only OpenAI is wired up (see OAClient)
+PROVIDER_DEFAULTS = {
+    "openai": {
+        "model": "gpt-5.2",
+        "embed_model": "text-embedding-3-small",
+        "temperature": 0.2,
+        "api_key_env": "OPENAI_API_KEY",
+    },
+}
+DEFAULTS = PROVIDER_DEFAULTS[OAClient.provider]
+
 def ensure_api_key():
-    # OpenAI SDK reads OPENAI_API_KEY from env automatically.
-    if not os.environ.get("OPENAI_API_KEY"):
-        raise SystemExit("ERROR: OPENAI_API_KEY is not set in your environment.")
+    # The SDK reads the key from env automatically.
+    env = DEFAULTS["api_key_env"]
+    if not os.environ.get(env):
+        raise SystemExit(f"ERROR: {env} is not set in your environment.")
 
 def cmd_new(args):
-    db = AssistantDB(args.db)
+    db = get_db(args.db)
     params = {"model": args.model, "temperature": args.temperature}
     dialog_id, root_id = db.create_dialog(args.title, args.system, params)
     # head is set inside create_dialog() after your update
@@ -24,7 +35,7 @@ def cmd_new(args):
     print("root_node:", root_id)
 
 def cmd_fork(args):
-    db = AssistantDB(args.db)
+    db = get_db(args.db)
     params = {"model": args.model, "temperature": args.temperature}
 
     from_node = args.from_node or db.get_head(args.dialog_id)
@@ -39,8 +50,11 @@ def cmd_fork(args):
     print("note:", note)
 
 def cmd_ask(args):
+    # check before the model call, so bad chunk settings cannot lose a paid reply
+    if not args.no_memory and not 0 <= args.chunk_overlap < args.chunk_chars:
+        raise SystemExit("ERROR: --chunk-overlap must be >= 0 and smaller than --chunk-chars.")
     ensure_api_key()
-    db = AssistantDB(args.db)
+    db = get_db(args.db)
 
     node_id = args.node_id or db.get_head(args.dialog_id)
     if not node_id:
@@ -52,43 +66,44 @@ def cmd_ask(args):
     db.append_message(args.dialog_id, node_id, "user", args.question)
 
     # call model
-    msgs = db.get_messages(args.dialog_id, node_id)
-    ans = oa.respond(msgs, temperature=args.temperature, max_tokens=args.max_tokens)
+    prompt = db.iter_messages_as_prompt(node_id)
+    ans = oa.respond_prompt(prompt, temperature=args.temperature, max_tokens=args.max_tokens)
 
     # store assistant reply
     db.append_message(args.dialog_id, node_id, "assistant", ans)
 
-    # optionally embed + store to memory
-    if not args.no_memory:
-        for ch in chunk_text(ans, max_chars=args.chunk_chars, overlap=args.chunk_overlap):
-            emb = oa.embed([ch])[0]
-            db.add_memory(args.dialog_id, node_id, ch, emb, {"type": "assistant_answer", "node": node_id})
-
-    # update head
-    db.set_head(args.dialog_id, node_id)
+    # optionally embed (one request for all chunks) + store to memory,
+    # committed together with the head update
+    chunks = [] if args.no_memory else chunk_text(ans, max_chars=args.chunk_chars, overlap=args.chunk_overlap)
+    embs = oa.embed(chunks) if chunks else []
+    meta = {"type": "assistant_answer", "node": node_id}
+    with db.transaction():
+        db.add_memories(args.dialog_id, node_id, [(ch, emb, meta) for ch, emb in zip(chunks, embs)])
+        db.set_head(args.dialog_id, node_id)
 
     print(ans.strip())
 
 def cmd_retrieve(args):
     ensure_api_key()
-    db = AssistantDB(args.db)
+    db = get_db(args.db)
     oa = OAClient(args.model, args.embed_model)
 
     hits = hybrid_retrieve(
         db, oa, args.dialog_id, args.query,
-        k_sem=args.k_sem, k_fts=args.k_fts, k_final=args.k
+        k_sem=args.k_sem, k_fts=args.k_fts, k_final=args.k, fusion=args.fusion
     )
 
     if not hits:
         print("(no hits)")
         return
 
-    for sim, mid, text, meta in hits:
-        print(f"\n--- id={mid} sim={sim:.4f} meta={meta}")
+    label = "sim" if args.fusion == "cosine" else "rrf"
+    for score, mid, text, meta in hits:
+        print(f"\n--- id={mid} {label}={score:.4f} meta={meta}")
         print(text.strip())
 
 def cmd_nodes(args):
-    db = AssistantDB(args.db)
+    db = get_db(args.db)
     head = db.get_head(args.dialog_id)
     rows = db.list_nodes(args.dialog_id, limit=args.limit)
     for node_id, parent_id, note, commit, created_at in rows:
@@ -96,21 +111,25 @@ def cmd_nodes(args):
         print(f"{node_id}  parent={parent_id}  commit={commit}  note={note}{mark}")
 
 def cmd_head(args):
-    db = AssistantDB(args.db)
+    db = get_db(args.db)
     head = db.get_head(args.dialog_id)
     print(head if head else "(no head set)")
 def cmd_checkout(args):
-    db = AssistantDB(args.db)
+    db = get_db(args.db)
     db.set_head_to_node(args.dialog_id, args.node_id)
     print("HEAD set to:", args.node_id)
 
 def cmd_tree(args):
-    db = AssistantDB(args.db)
+    db = get_db(args.db)
     head = db.get_head(args.dialog_id)
 
-    # fetch nodes for dialog
+    # children per parent, grouped by SQLite; the ordered subquery keeps
+    # siblings in created_at order inside each GROUP_CONCAT
     rows = db.conn.execute(
-        "SELECT node_id, parent_id, note FROM nodes WHERE dialog_id=? ORDER BY created_at ASC",
+        """SELECT parent_id, GROUP_CONCAT(node_id, CHAR(31))
+           FROM (SELECT node_id, parent_id FROM nodes WHERE dialog_id=?
+                 ORDER BY parent_id, created_at)
+           GROUP BY parent_id""",
         (args.dialog_id,)
     ).fetchall()
 
@@ -118,19 +137,17 @@ def cmd_tree(args):
         print("(no nodes)")
         return
 
-    children = defaultdict(list)
-    parent_of = {}
-    note_of = {}
-
-    root = None
-    for nid, pid, note in rows:
-        parent_of[nid] = pid
-        note_of[nid] = note
-        children[pid].append(nid)
-        if pid is None:
-            root = nid
-
-    def walk(nid, prefix="", is_last=True):
+    children = {pid: kids.split("\x1f") for pid, kids in rows}
+    note_of = dict(db.conn.execute(
+        "SELECT node_id, note FROM nodes WHERE dialog_id=?", (args.dialog_id,)
+    ))
+    root = children.get(None, [None])[0]
+
+    # depth-first with an explicit stack (deep branch chains would overflow recursion);
+    # children are pushed in reverse so they pop in created_at order
+    stack = [(root, "", True)]
+    while stack:
+        nid, prefix, is_last = stack.pop()
         mark = " <HEAD>" if nid == head else ""
         label = f"{nid} [{note_of.get(nid,'')}]"
         if prefix == "":
@@ -140,15 +157,13 @@ def cmd_tree(args):
             print(prefix + branch + label + mark)
 
         kids = children.get(nid, [])
-        for i, kid in enumerate(kids):
-            last = (i == len(kids) - 1)
-            ext = "    " if is_last else "│   "
-            walk(kid, prefix + ext, last)
-
-    walk(root)
+        ext = prefix + ("    " if is_last else "│   ")
+        last = len(kids) - 1
+        for i in range(last, -1, -1):
+            stack.append((kids[i], ext, i == last))
 
 def cmd_diff(args):
-    db = AssistantDB(args.db)
+    db = get_db(args.db)
 
     a = args.a
     b = args.b
@@ -168,13 +183,9 @@ def cmd_diff(args):
 
     # messages are materialized per node (copied on fork),
     # so diff is just: suffix after LCA message length.
-    msgs_lca = db.messages_for_node(lca)
-    msgs_a = db.messages_for_node(a)
-    msgs_b = db.messages_for_node(b)
-
-    n = len(msgs_lca)
-    add_a = msgs_a[n:]
-    add_b = msgs_b[n:]
+    n = db.message_count(lca)
+    add_a = db.messages_after(a, n)
+    add_b = db.messages_after(b, n)
 
     print("LCA:", lca)
     print("\n=== Only in A (after LCA) ===")
@@ -200,8 +211,8 @@ def main():
     p_new = sp.add_parser("new", help="Create a new dialog (root node).")
     p_new.add_argument("--title", required=True)
     p_new.add_argument("--system", required=True, help="System prompt for the dialog.")
-    p_new.add_argument("--model", default="gpt-5.2")
-    p_new.add_argument("--temperature", type=float, default=0.2)
+    p_new.add_argument("--model", default=DEFAULTS["model"])
+    p_new.add_argument("--temperature", type=float, default=DEFAULTS["temperature"])
     p_new.set_defaults(func=cmd_new)
 
     # fork
@@ -210,8 +221,8 @@ def main():
     p_fork.add_argument("--from-node", dest="from_node", default=None)
     p_fork.add_argument("--note", default=None, help="Branch note; if omitted, auto-named.")
     p_fork.add_argument("--prefix", default="branch", help="Prefix for auto branch naming.")
-    p_fork.add_argument("--model", default="gpt-5.2")
-    p_fork.add_argument("--temperature", type=float, default=0.2)
+    p_fork.add_argument("--model", default=DEFAULTS["model"])
+    p_fork.add_argument("--temperature", type=float, default=DEFAULTS["temperature"])
     p_fork.set_defaults(func=cmd_fork)
 
     # ask
@@ -219,9 +230,9 @@ def main():
     p_ask.add_argument("--dialog-id", required=True)
     p_ask.add_argument("--node-id", dest="node_id", default=None)
     p_ask.add_argument("--question", required=True)
-    p_ask.add_argument("--model", default="gpt-5.2")
-    p_ask.add_argument("--embed-model", default="text-embedding-3-small")
-    p_ask.add_argument("--temperature", type=float, default=0.2)
+    p_ask.add_argument("--model", default=DEFAULTS["model"])
+    p_ask.add_argument("--embed-model", default=DEFAULTS["embed_model"])
+    p_ask.add_argument("--temperature", type=float, default=DEFAULTS["temperature"])
     p_ask.add_argument("--max-tokens", type=int, default=900)
     p_ask.add_argument("--no-memory", action="store_true", help="Do not store response chunks into memory.")
     p_ask.add_argument("--chunk-chars", type=int, default=1800)
@@ -232,11 +243,13 @@ def main():
     p_ret = sp.add_parser("retrieve", help="Retrieve from memory (hybrid semantic + keyword).")
     p_ret.add_argument("--dialog-id", required=True)
     p_ret.add_argument("--query", required=True)
-    p_ret.add_argument("--model", default="gpt-5.2")
-    p_ret.add_argument("--embed-model", default="text-embedding-3-small")
+    p_ret.add_argument("--model", default=DEFAULTS["model"])
+    p_ret.add_argument("--embed-model", default=DEFAULTS["embed_model"])
     p_ret.add_argument("--k", type=int, default=5)
     p_ret.add_argument("--k-sem", type=int, default=10)
     p_ret.add_argument("--k-fts", type=int, default=10)
+    p_ret.add_argument("--fusion", choices=["cosine", "rrf"], default="cosine",
+                       help="Rank the union by cosine similarity or by reciprocal rank fusion.")
     p_ret.set_defaults(func=cmd_retrieve)
 
     # nodes
@@ -1,24 +1,86 @@
 import numpy as np
 import json
+from utils import content_key
 
-def hybrid_retrieve(db, oa, dialog_id, query, k_sem=10, k_fts=10, k_final=5):
-    q_emb = oa.embed([query])[0]
+# orjson is optional: faster meta_json decoding when installed
+try:
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
+
+RRF_K = 60
+
+# Reciprocal Rank Fusion of the semantic ranks (bound as a JSON array of
+# memory_ids, best first) and the FTS5 bm25 ranks, summed per memory_id.
+_RRF_SQL = """
+WITH sem(memory_id, r) AS (
+  SELECT value, key + 1 FROM json_each(?)
+),
+kw(memory_id, r) AS (
+  SELECT memory_id, row_number() OVER (ORDER BY rank) FROM (
+    SELECT f.rowid AS memory_id, f.rank AS rank
+    FROM memory_fts f
+    JOIN memory m ON m.memory_id = f.rowid
+    WHERE memory_fts MATCH ? AND m.dialog_id = ?
+    ORDER BY f.rank
+    LIMIT ?
+  )
+),
+fused(memory_id, score) AS (
+  SELECT memory_id, SUM(1.0 / (? + r))
+  FROM (SELECT memory_id, r FROM sem UNION ALL SELECT memory_id, r FROM kw)
+  GROUP BY memory_id
+)
+SELECT fu.score, m.memory_id, m.text, m.meta_json
+FROM fused fu
+JOIN memory m ON m.memory_id = fu.memory_id
+ORDER BY fu.score DESC
+LIMIT ?
+"""
+
+def _top_k(scores, k):
+    """Indices of the k largest scores, best first: O(N) partition, then sort only k."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+def embed_cached(db, oa, texts):
+    """oa.embed(texts), consulting the database's embedding_cache first."""
+    keys = [content_key(t) for t in texts]
+    hit = db.get_cached_embeddings(oa.provider, oa.embed_model, keys)
+    misses = {k: t for k, t in zip(keys, texts) if k not in hit}
+    if misses:
+        fresh = dict(zip(misses, oa.embed(list(misses.values()))))
+        db.put_cached_embeddings(oa.provider, oa.embed_model, fresh.items())
+        hit.update(fresh)
+    return np.stack([hit[k] for k in keys])
+
+def hybrid_retrieve(db, oa, dialog_id, query, k_sem=10, k_fts=10, k_final=5, fusion="cosine"):
+    """Return [(score, memory_id, text, meta)] best first.
+
+    fusion="cosine" reranks the semantic + keyword union by cosine similarity;
+    fusion="rrf" ranks it by reciprocal rank fusion, computed in SQL.
+    """
+    if fusion not in ("cosine", "rrf"):
+        raise ValueError(f"unknown fusion {fusion!r}; expected 'cosine' or 'rrf'")
+    q_emb = embed_cached(db, oa, [query])[0]
     qv = np.asarray(q_emb, dtype=np.float32)
-    qn = float(np.linalg.norm(qv) + 1e-12)
+    qv = qv / (np.linalg.norm(qv) + 1e-12)
 
-    # semantic shortlist (scan dialog memory)
-    sem_rows = db.conn.execute(
-        "SELECT memory_id, text, embedding, norm, meta_json FROM memory WHERE dialog_id=?",
-        (dialog_id,)
-    ).fetchall()
+    # semantic shortlist (one matmul over the cached dialog matrix); candidates are
+    # carried as row positions into ids/M/sims instead of per-row Python tuples
+    ids, M = db.get_embedding_matrix(dialog_id)
+    sims = M @ qv if len(ids) else np.empty(0, dtype=np.float32)
+    sem_pos = _top_k(sims, k_sem)
 
-    sem_scored = []
-    for mid, text, blob, norm, meta_json in sem_rows:
-        v = np.frombuffer(blob, dtype=np.float32)
-        sim = float(np.dot(qv, v) / (qn * norm))
-        sem_scored.append((sim, mid))
-    sem_scored.sort(reverse=True, key=lambda x: x[0])
-    sem_ids = [mid for _, mid in sem_scored[:k_sem]]
+    if fusion == "rrf":
+        rows = db.conn.execute(
+            _RRF_SQL,
+            (json.dumps(ids[sem_pos].tolist()), query, dialog_id, k_fts, RRF_K, k_final)
+        ).fetchall()
+        return [(score, mid, text, _loads(meta_json)) for score, mid, text, meta_json in rows]
 
     # keyword shortlist via FTS5 (dialog constrained)
     fts_rows = db.conn.execute(
@@ -26,29 +88,29 @@ def hybrid_retrieve(db, oa, dialog_id, query, k_sem=10, k_fts=10, k_final=5):
         SELECT f.rowid
         FROM memory_fts f
         JOIN memory m ON m.memory_id = f.rowid
-        WHERE f MATCH ? AND m.dialog_id = ?
+        WHERE memory_fts MATCH ? AND m.dialog_id = ?
         LIMIT ?
         """,
         (query, dialog_id, k_fts)
     ).fetchall()
-    fts_ids = [int(r[0]) for r in fts_rows]
-
-    # union + rerank by cosine
-    union = list(dict.fromkeys(sem_ids + fts_ids))
-    if not union:
+    if not len(ids):
         return []
+    fts_ids = np.fromiter((r[0] for r in fts_rows), dtype=np.int64, count=len(fts_rows))
+    fts_pos = np.minimum(np.searchsorted(ids, fts_ids), len(ids) - 1)
+    fts_pos = fts_pos[ids[fts_pos] == fts_ids]
 
-    qmarks = ",".join(["?"] * len(union))
-    rows = db.conn.execute(
-        f"SELECT memory_id, text, embedding, norm, meta_json FROM memory WHERE memory_id IN ({qmarks})",
-        union
-    ).fetchall()
-
-    rescored = []
-    for mid, text, blob, norm, meta_json in rows:
-        v = np.frombuffer(blob, dtype=np.float32)
-        sim = float(np.dot(qv, v) / (qn * norm))
-        rescored.append((sim, mid, text, json.loads(meta_json)))
-    rescored.sort(reverse=True, key=lambda x: x[0])
+    # union + rerank by cosine: every candidate has a row in M, so its score
+    # is already in sims and only the k_final winners need to leave SQLite
+    cand = np.unique(np.concatenate([sem_pos, fts_pos]))  # order is irrelevant, _top_k reranks
+    top = cand[_top_k(sims[cand], k_final)]
+    if not len(top):
+        return []
+    top_ids = ids[top].tolist()
 
-    return rescored[:k_final]
\ No newline at end of file
+    qmarks = ",".join(["?"] * len(top_ids))
+    rows = dict((r[0], r[1:]) for r in db.conn.execute(
+        f"SELECT memory_id, text, meta_json FROM memory WHERE memory_id IN ({qmarks})",
+        top_ids
+    ))
+    return [(float(sims[p]), mid, rows[mid][0], _loads(rows[mid][1]))
+            for p, mid in zip(top, top_ids)]
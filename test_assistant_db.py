@@ -0,0 +1,140 @@
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+import pytest
+
+from assistant_db import AssistantDB, SCHEMA_VERSION
+from utils import chunk_text, compute_commit
+
+
+def test_add_memory_after_caching_an_empty_dialog(tmp_path):
+    db = AssistantDB(str(tmp_path / "t.sqlite"))
+    dialog_id, root = db.create_dialog("t", "sys", {})
+
+    ids, _ = db.get_embedding_matrix(dialog_id)  # what retrieve on a new dialog does
+    assert len(ids) == 0
+
+    db.add_memory(dialog_id, root, "first", np.ones(8, dtype=np.float32), {})
+    ids, M = db.get_embedding_matrix(dialog_id)
+    assert len(ids) == 1 and M.shape == (1, 8)
+
+    db.add_memory(dialog_id, root, "second", np.arange(8, dtype=np.float32), {})
+    ids, M = db.get_embedding_matrix(dialog_id)
+    assert len(ids) == 2 and M.shape == (2, 8)
+
+
+def test_add_memory_with_new_embedding_width_reloads_cache(tmp_path):
+    db = AssistantDB(str(tmp_path / "t.sqlite"))
+    dialog_id, root = db.create_dialog("t", "sys", {})
+    db.add_memory(dialog_id, root, "small", np.ones(8, dtype=np.float32), {})
+    assert db.get_embedding_matrix(dialog_id)[1].shape == (1, 8)
+
+    db.add_memory(dialog_id, root, "wide", np.ones(16, dtype=np.float32), {})
+    assert db.conn.execute("SELECT COUNT(*) FROM memory").fetchone()[0] == 2
+    assert dialog_id not in db._emb_cache
+
+
+def test_mixed_embedding_dimensions_fail_loudly(tmp_path):
+    db = AssistantDB(str(tmp_path / "t.sqlite"))
+    dialog_id, root = db.create_dialog("t", "sys", {})
+    db.add_memory(dialog_id, root, "a", np.ones(1536, dtype=np.float32), {})
+    db.add_memory(dialog_id, root, "b", np.ones(512, dtype=np.float32), {})
+    with pytest.raises(ValueError, match=r"mixed embedding dimensions \[512, 1536\]"):
+        db.get_embedding_matrix(dialog_id)
+
+
+# memory layout before int8 quantization: raw float32 blob next to its norm
+BASELINE_MEMORY_SQL = """
+CREATE TABLE memory (
+  memory_id INTEGER PRIMARY KEY AUTOINCREMENT,
+  dialog_id TEXT NOT NULL,
+  node_id TEXT,
+  text TEXT NOT NULL,
+  embedding BLOB NOT NULL,
+  norm REAL NOT NULL,
+  meta_json TEXT NOT NULL,
+  created_at REAL NOT NULL
+);
+CREATE VIRTUAL TABLE memory_fts
+USING fts5(text, content='memory', content_rowid='memory_id');
+CREATE TRIGGER memory_ai AFTER INSERT ON memory BEGIN
+  INSERT INTO memory_fts(rowid, text) VALUES (new.memory_id, new.text);
+END;
+CREATE TRIGGER memory_au AFTER UPDATE ON memory BEGIN
+  INSERT INTO memory_fts(memory_fts, rowid, text) VALUES('delete', old.memory_id, old.text);
+  INSERT INTO memory_fts(rowid, text) VALUES (new.memory_id, new.text);
+END;
+"""
+
+
+def test_migrate_baseline_float32_norm_memory(tmp_path, monkeypatch):
+    path = str(tmp_path / "old.sqlite")
+    rng = np.random.default_rng(0)
+    vecs = rng.standard_normal((3, 64)).astype(np.float32) * 5
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_MEMORY_SQL)
+    conn.executemany(
+        "INSERT INTO memory(dialog_id, node_id, text, embedding, norm, meta_json, created_at) "
+        "VALUES ('d', NULL, ?, ?, ?, '{}', 0)",
+        [(f"m{i}", v.tobytes(), float(np.linalg.norm(v))) for i, v in enumerate(vecs)]
+    )
+    conn.commit()
+    conn.close()
+
+    db = AssistantDB(path)
+    cols = {r[1] for r in db.conn.execute("PRAGMA table_info(memory)")}
+    assert "norm" not in cols and "scale" in cols
+    assert db.conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    ids, M = db.get_embedding_matrix("d")
+    expected = vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+    cos = np.sum(M * expected, axis=1) / np.linalg.norm(M, axis=1)
+    assert len(ids) == 3 and np.all(cos > 0.999)
+    db.conn.close()
+
+    def fail():
+        raise AssertionError("migration ran twice")
+    monkeypatch.setattr(AssistantDB, "_migrate", lambda self: fail())
+    db = AssistantDB(path)
+    assert np.array_equal(db.get_embedding_matrix("d")[1], M)
+    assert db.conn.execute("SELECT rowid FROM memory_fts WHERE memory_fts MATCH 'm1'").fetchall() == [(2,)]
+
+
+def _old_compute_commit(parent_commit, added_messages, params):
+    h = hashlib.sha256()
+    h.update((parent_commit or "").encode())
+    h.update(json.dumps(added_messages, sort_keys=True).encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()[:12]
+
+
+@pytest.mark.parametrize("parent, messages, params", [
+    (None, [], {}),
+    ("abc123", [{"role": "user", "content": "hi"}], {"model": "m", "temperature": 0.2}),
+    ("abc123", [{"role": "user", "content": "héllo — 你好 🙂", "meta": {"z": [1, {"b": 2, "a": None}], "a": True}},
+                {"role": "assistant", "content": "ok"}], {"nested": {"y": [1.5, "ü"], "x": {}}}),
+])
+def test_compute_commit_matches_single_json_dumps(parent, messages, params):
+    assert compute_commit(parent, messages, params) == _old_compute_commit(parent, messages, params)
+
+
+def _old_chunk_text(text, max_chars=1800, overlap=200):
+    text = text.strip()
+    chunks = []
+    i = 0
+    while i < len(text):
+        j = min(len(text), i + max_chars)
+        chunks.append(text[i:j])
+        if j == len(text):
+            break
+        i = max(0, j - overlap)
+    return chunks
+
+
+@pytest.mark.parametrize("max_chars, overlap", [(1800, 200), (10, 3), (10, 0), (10, 9), (1, 0)])
+def test_chunk_text_matches_old_loop(max_chars, overlap):
+    for n in [0, 1, 2, 9, 10, 11, 16, 17, 18, 100, 1799, 1800, 1801, 3401, 5000]:
+        text = "".join(chr(ord("a") + i % 26) for i in range(n))
+        assert chunk_text(text, max_chars, overlap) == _old_chunk_text(text, max_chars, overlap), n
+    assert chunk_text("  \n padded  \n", max_chars, overlap) == _old_chunk_text("  \n padded  \n", max_chars, overlap)
@@ -1,4 +1,5 @@
-import time, uuid, hashlib, json
+import io, time, uuid, hashlib, json
+import numpy as np
 
 def now():
     return time.time()
@@ -6,21 +7,70 @@ def now():
 def new_id(n=12):
     return uuid.uuid4().hex[:n]
 
+ROLE_MAP = {"system": "SYSTEM", "user": "USER", "assistant": "ASSISTANT"}
+
+def format_prompt(messages):
+    """Flatten (role, content) pairs into 'ROLE: content' blocks separated by blank lines."""
+    buf = io.StringIO()
+    for i, (role, content) in enumerate(messages):
+        if i:
+            buf.write("\n\n")
+        buf.write(ROLE_MAP.get(role) or role.upper())
+        buf.write(": ")
+        buf.write(content)
+    return buf.getvalue()
+
+def content_key(text):
+    """Short digest identifying a text, for embedding caches."""
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
 def compute_commit(parent_commit, added_messages, params):
     h = hashlib.sha256()
     h.update((parent_commit or "").encode())
-    h.update(json.dumps(added_messages, sort_keys=True).encode())
-    h.update(json.dumps(params, sort_keys=True).encode())
+    _update_json(h, added_messages)
+    _update_json(h, params)
     return h.hexdigest()[:12]
 
+def _update_json(h, obj):
+    # feed h the same bytes as json.dumps(obj, sort_keys=True), one list item
+    # at a time, so a long message list is never serialized as a single string
+    if not isinstance(obj, list):
+        h.update(json.dumps(obj, sort_keys=True).encode())
+        return
+    h.update(b"[")
+    for i, item in enumerate(obj):
+        if i:
+            h.update(b", ")
+        h.update(json.dumps(item, sort_keys=True).encode())
+    h.update(b"]")
+
+def quantize_int8(v):
+    """Symmetric per-vector int8 quantization: v ~= q * scale."""
+    v = np.asarray(v, dtype=np.float32)
+    scale = float(np.max(np.abs(v))) / 127.0 if v.size else 0.0
+    if scale == 0.0:
+        return np.zeros(v.shape, dtype=np.int8), 1.0
+    return np.round(v / scale).astype(np.int8), scale
+
+def dequantize_int8_rows(blobs, scales):
+    """Decode equal-length int8 blobs into one (N, D) float32 matrix in a single pass."""
+    if not len(blobs):
+        return np.empty((0, 0), dtype=np.float32)
+    dims = {len(b) for b in blobs}
+    if len(dims) > 1:
+        raise ValueError(f"mixed embedding dimensions {sorted(dims)}; cannot stack into one matrix")
+    q = np.frombuffer(b"".join(blobs), dtype=np.int8).reshape(len(blobs), -1)
+    out = np.empty(q.shape, dtype=np.float32)
+    np.multiply(q, np.asarray(scales, dtype=np.float32)[:, None], out=out)
+    return out
+
 def chunk_text(text, max_chars=1800, overlap=200):
     text = text.strip()
-    chunks = []
-    i = 0
-    while i < len(text):
-        j = min(len(text), i + max_chars)
-        chunks.append(text[i:j])
-        if j == len(text):
-            break
-        i = max(0, j - overlap)
-    return chunks
\ No newline at end of file
+    n = len(text)
+    step = max_chars - overlap
+    if step <= 0:
+        raise ValueError("overlap must be smaller than max_chars")
+    if not n:
+        return []
+    # chunk starts are a fixed stride; stop once a chunk has reached the end
+    return [text[i:i + max_chars] for i in range(0, max(n - overlap, 1), step)]
\ No newline at end of file